@@ -5,17 +5,68 @@ echo
 # Remove "$NEWROOT"/.successful-update if exists
 rm -f "$NEWROOT"/.successful-update "$NEWROOT"/.update
 
+# Refuse an update that was not fully staged or that failed verification.
+# Updates staged by versions without manifests carry neither marker and are
+# applied as before.
+if [ -d "$NEWROOT"/.update_rootfs ] && {
+    [ -e "$NEWROOT"/.update_rootfs/.staging ] ||
+    { [ -f "$NEWROOT"/.update_rootfs/.manifest.json ] && [ ! -f "$NEWROOT"/.update_rootfs/.verified ]; }
+}; then
+    echo "Refusing to apply incomplete or damaged update."
+
+    # Put back the boot files it replaced. Only possible if /boot is on the
+    # root filesystem and the file names match, as grub.cfg is left as is;
+    # otherwise 'system verify' or the next update restores them.
+    previous_boot="$NEWROOT"/.update_rootfs/.previous-boot
+    new_boot_files="$NEWROOT"/.update_rootfs/.new-boot-files
+    if [ -d "$previous_boot" ] && [ -f "$new_boot_files" ]; then
+        restorable=1
+        while read -r f; do
+            if [ ! -f "$NEWROOT/boot/$f" ] || [ ! -e "$previous_boot/$f" ]; then
+                restorable=0
+            fi
+        done < "$new_boot_files"
+        for f in "$previous_boot"/*; do
+            if [ -e "$f" ] && ! grep -qxF "${f##*/}" "$new_boot_files"; then
+                restorable=0
+            fi
+        done
+
+        if [ "$restorable" = 1 ]; then
+            for f in "$previous_boot"/*; do
+                [ -e "$f" ] && mv -f "$f" "$NEWROOT"/boot/
+            done
+            rm -rf "$previous_boot" "$new_boot_files"
+        fi
+    fi
+
+    rm -rf "$NEWROOT"/.failed.update_rootfs
+    mv "$NEWROOT"/.update_rootfs "$NEWROOT"/.failed.update_rootfs
+fi
+
 # Detect if update downloaded.
 if [ -d "$NEWROOT"/.update_rootfs ]; then
     # Available, rename old /usr and move new /usr to /.
-    if [ -d "$NEWROOT"/.update_rootfs/usr ]; then
-        rm -rf "$NEWROOT"/.old.usr
-        mv "$NEWROOT"/usr "$NEWROOT"/.old.usr >/dev/null 2>&1
-        mv "$NEWROOT"/.update_rootfs/usr "$NEWROOT"/usr
+    # /usr is either a directory or an EROFS image mounted on an empty /usr.
+    if [ -f "$NEWROOT"/.update_rootfs/usr.erofs ] || [ -d "$NEWROOT"/.update_rootfs/usr ]; then
+        rm -rf "$NEWROOT"/.old.usr "$NEWROOT"/.old.usr.erofs
+        if [ -f "$NEWROOT"/usr.erofs ]; then
+            mv "$NEWROOT"/usr.erofs "$NEWROOT"/.old.usr.erofs
+        else
+            mv "$NEWROOT"/usr "$NEWROOT"/.old.usr >/dev/null 2>&1
+        fi
+
+        if [ -f "$NEWROOT"/.update_rootfs/usr.erofs ]; then
+            mkdir -p "$NEWROOT"/usr
+            mv "$NEWROOT"/.update_rootfs/usr.erofs "$NEWROOT"/usr.erofs
+        else
+            rmdir "$NEWROOT"/usr >/dev/null 2>&1
+            mv "$NEWROOT"/.update_rootfs/usr "$NEWROOT"/usr
+        fi
     fi
 
     # Same for /etc.
-    if [ -d "$NEWROOT"/.update_rootfs/etc ]; then
+    if [ -d "$NEWROOT"/.update_rootfs/etc ] && [ ! -f "$NEWROOT"/usr.erofs ]; then
         mv "$NEWROOT"/.update_rootfs/etc "$NEWROOT"/usr/etc
     fi
     if [ -d "$NEWROOT"/.new.etc ]; then
@@ -47,6 +98,27 @@ for i in usr varlibpacman usrlocal; do
     mkdir -p "$NEWROOT"/.commonarch-overlays/$i.workdir
 done
 
-mount -t overlay overlay -o index=off -o metacopy=off -o ro,lowerdir="$NEWROOT"/usr,upperdir="$NEWROOT"/.commonarch-overlays/usr,workdir="$NEWROOT"/.commonarch-overlays/usr.workdir "$NEWROOT"/usr
+usr_lowerdir="$NEWROOT"/usr
+if [ -f "$NEWROOT"/usr.erofs ]; then
+    usr_lowerdir="$NEWROOT"/.commonarch-overlays/usr.lowerdir
+    mkdir -p "$usr_lowerdir"
+    if ! mount -t erofs -o ro,loop "$NEWROOT"/usr.erofs "$usr_lowerdir"; then
+        # Put the previous /usr back rather than boot with an empty one
+        echo "Failed to mount /usr.erofs; falling back to the previous /usr."
+        rm -f "$NEWROOT"/.failed.usr.erofs
+        if [ -f "$NEWROOT"/.old.usr.erofs ]; then
+            mv "$NEWROOT"/usr.erofs "$NEWROOT"/.failed.usr.erofs
+            mv "$NEWROOT"/.old.usr.erofs "$NEWROOT"/usr.erofs
+            mount -t erofs -o ro,loop "$NEWROOT"/usr.erofs "$usr_lowerdir"
+        elif [ -d "$NEWROOT"/.old.usr ]; then
+            mv "$NEWROOT"/usr.erofs "$NEWROOT"/.failed.usr.erofs
+            rmdir "$NEWROOT"/usr
+            mv "$NEWROOT"/.old.usr "$NEWROOT"/usr
+            usr_lowerdir="$NEWROOT"/usr
+        fi
+    fi
+fi
+
+mount -t overlay overlay -o index=off -o metacopy=off -o ro,lowerdir="$usr_lowerdir",upperdir="$NEWROOT"/.commonarch-overlays/usr,workdir="$NEWROOT"/.commonarch-overlays/usr.workdir "$NEWROOT"/usr
 mount -t overlay overlay -o index=off -o metacopy=off -o ro,lowerdir="$NEWROOT"/var/lib/pacman,upperdir="$NEWROOT"/.commonarch-overlays/varlibpacman,workdir="$NEWROOT"/.commonarch-overlays/varlibpacman.workdir "$NEWROOT"/var/lib/pacman
 mount -t overlay overlay -o rw,lowerdir="$NEWROOT"/usr/local,upperdir="$NEWROOT"/.commonarch-overlays/usrlocal,workdir="$NEWROOT"/.commonarch-overlays/usrlocal.workdir "$NEWROOT"/usr/local
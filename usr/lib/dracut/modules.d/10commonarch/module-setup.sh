@@ -10,11 +10,12 @@ depends() {
 }
 
 installkernel() {
-    hostonly="" instmods overlay
+    hostonly="" instmods overlay erofs loop
 }
 
 install() {
     inst touch
+    inst grep
 
     inst_hook pre-pivot 15 "$moddir/handle-update.sh"
 }
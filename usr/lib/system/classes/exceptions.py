@@ -8,3 +8,13 @@ class ImageMetadataException(Exception):
 
 class UnsupportedPkgManagerException(Exception):
     pass
+
+
+class RegistryException(Exception):
+    pass
+
+
+class IncompleteBlobException(RegistryException):
+    def __init__(self, message: str = "", transferred: int = 0) -> None:
+        super().__init__(message)
+        self.transferred = transferred
@@ -0,0 +1,148 @@
+import json
+import os
+import time
+
+import fasteners
+
+
+class SystemLock:
+    """Handles the system lock and metadata about its holder.
+
+    Writers (anything changing the system) exclude each other and readers;
+    readers only exclude writers. The holder of the write lock records its
+    pid, command, phase, start time and progress in a runtime file.
+
+    Attributes:
+        command: A string describing the command holding the lock.
+        lock_path: A string containing the path to the lock file.
+        holder_path: A string containing the path to the holder metadata.
+    """
+
+    def __init__(
+        self,
+        command: str,
+        lock_path: str = "/var/lib/commonarch/.system-lock",
+        holder_path: str = "/run/commonarch/system-lock.json",
+    ) -> None:
+        """Initialises the instance based on a command and lock path.
+
+        Args:
+            command: Command that will hold the lock.
+            lock_path: Path to the lock file.
+            holder_path: Path to the holder metadata; on a tmpfs, so that it
+                is neither copied into a staged /var/lib nor kept across boots.
+        """
+        self.command = command
+        self.lock_path = lock_path
+        self.holder_path = holder_path
+        self.lock = fasteners.InterProcessReaderWriterLock(lock_path)
+        self.exclusive = None
+        self.holder = None
+
+    def acquire(self, exclusive: bool = True, timeout: float = None) -> bool:
+        """Acquire the lock.
+
+        Args:
+            exclusive: Whether to acquire the write lock rather than a read lock.
+            timeout: Seconds to wait; None waits indefinitely, 0 not at all.
+
+        Returns:
+            True if the lock was acquired; otherwise False.
+        """
+        acquire = (
+            self.lock.acquire_write_lock if exclusive else self.lock.acquire_read_lock
+        )
+
+        if not acquire(blocking=timeout != 0, timeout=timeout or None):
+            return False
+
+        self.exclusive = exclusive
+
+        if exclusive:
+            self.holder = {
+                "pid": os.getpid(),
+                "command": self.command,
+                "phase": None,
+                "started": time.time(),
+                "progress": None,
+            }
+            self.write_holder()
+
+        return True
+
+    def release(self) -> None:
+        """Release the lock."""
+        if self.exclusive:
+            try:
+                os.remove(self.holder_path)
+            except FileNotFoundError:
+                pass
+            self.lock.release_write_lock()
+        else:
+            self.lock.release_read_lock()
+
+        self.exclusive = None
+        self.holder = None
+
+    def update(self, phase: str = None, progress: float = None) -> None:
+        """Update the holder metadata.
+
+        Args:
+            phase: Description of the current phase, resetting progress.
+            progress: Fraction of the current phase completed.
+        """
+        if self.holder is None:
+            return
+
+        if phase is not None:
+            self.holder["phase"] = phase
+            self.holder["progress"] = None
+        if progress is not None:
+            self.holder["progress"] = progress
+
+        self.write_holder()
+
+    def write_holder(self) -> None:
+        """Atomically write the holder metadata."""
+        os.makedirs(os.path.dirname(self.holder_path), exist_ok=True)
+        with open(f"{self.holder_path}.tmp", "w") as f:
+            json.dump(self.holder, f)
+        os.replace(f"{self.holder_path}.tmp", self.holder_path)
+
+    def read_holder(self) -> dict:
+        """Read the metadata of the current write lock holder.
+
+        Returns:
+            Dict containing the holder metadata, or None if not held.
+        """
+        try:
+            with open(self.holder_path) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def is_stale(self, holder: dict) -> bool:
+        """Check if holder metadata was left behind by a dead process.
+
+        Args:
+            holder: Dict containing holder metadata.
+
+        Returns:
+            True if the holder process no longer exists; otherwise False.
+        """
+        try:
+            os.kill(holder["pid"], 0)
+        except ProcessLookupError:
+            return True
+        except (PermissionError, KeyError, TypeError):
+            pass
+
+        return False
+
+    def __enter__(self):
+        if self.exclusive is None:
+            self.acquire()
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.release()
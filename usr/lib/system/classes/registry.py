@@ -0,0 +1,199 @@
+import http.client
+import json
+import platform
+import re
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+
+from classes.exceptions import IncompleteBlobException, RegistryException
+
+MANIFEST_MEDIA_TYPES = [
+    "application/vnd.oci.image.index.v1+json",
+    "application/vnd.oci.image.manifest.v1+json",
+    "application/vnd.docker.distribution.manifest.list.v2+json",
+    "application/vnd.docker.distribution.manifest.v2+json",
+]
+
+INDEX_MEDIA_TYPES = [
+    "application/vnd.oci.image.index.v1+json",
+    "application/vnd.docker.distribution.manifest.list.v2+json",
+]
+
+ARCHITECTURES = {"x86_64": "amd64", "aarch64": "arm64"}
+
+
+class Registry:
+    """Handles blob transfers from an OCI registry.
+
+    Only anonymous and bearer token access is supported; anything else is
+    left to skopeo.
+
+    Attributes:
+        host: A string containing the registry host.
+        repository: A string containing the repository within the registry.
+        reference: A string containing the tag or digest of the image.
+        rate_limit: Maximum transfer rate in bytes per second, or None.
+    """
+
+    def __init__(self, image_name: str, rate_limit: int = None) -> None:
+        """Initialises the instance based on a skopeo image name.
+
+        Args:
+            image_name: Image in skopeo's docker:// transport format.
+            rate_limit: Maximum transfer rate in bytes per second.
+        """
+        if not image_name.startswith("docker://"):
+            raise RegistryException(f"unsupported transport for {image_name}")
+
+        name = image_name[len("docker://") :]
+
+        if "@" in name:
+            name, self.reference = name.split("@", 1)
+        elif ":" in name.rsplit("/", 1)[-1]:
+            name, self.reference = name.rsplit(":", 1)
+        else:
+            self.reference = "latest"
+
+        host, _, repository = name.partition("/")
+        if not repository or not ("." in host or ":" in host or host == "localhost"):
+            host, repository = "docker.io", name
+
+        if host == "docker.io":
+            host = "registry-1.docker.io"
+            if "/" not in repository:
+                repository = f"library/{repository}"
+
+        self.host = host
+        self.repository = repository
+        self.rate_limit = rate_limit
+        self.token = None
+
+        # Local registry stand-ins usually do not speak TLS
+        self.scheme = (
+            "http"
+            if host.split(":")[0] in ("localhost", "127.0.0.1", "::1")
+            else "https"
+        )
+
+    def request(self, path: str, headers: dict = None):
+        """Perform an authenticated GET request against the registry.
+
+        Args:
+            path: Path below /v2/<repository>/.
+            headers: Dict containing additional request headers.
+
+        Returns:
+            The open HTTP response.
+        """
+        url = f"{self.scheme}://{self.host}/v2/{self.repository}/{path}"
+
+        for attempt in range(2):
+            req = urllib.request.Request(url, headers=headers or {})
+            if self.token:
+                # Unredirected so that it is not leaked to blob storage CDNs
+                req.add_unredirected_header("Authorization", f"Bearer {self.token}")
+
+            try:
+                return urllib.request.urlopen(req, timeout=60)
+            except urllib.error.HTTPError as e:
+                # Tokens expire mid-pull, so get a fresh one on any first 401
+                if e.code == 401 and attempt == 0:
+                    self.authenticate(e.headers.get("WWW-Authenticate", ""))
+                    continue
+                raise RegistryException(f"{url}: HTTP {e.code}")
+            except OSError as e:
+                raise RegistryException(f"{url}: {e}")
+
+        raise RegistryException(f"{url}: authentication failed")
+
+    def authenticate(self, challenge: str) -> None:
+        """Obtain an anonymous bearer token.
+
+        Args:
+            challenge: Value of the WWW-Authenticate header.
+        """
+        if not challenge.lower().startswith("bearer "):
+            raise RegistryException(f"unsupported authentication for {self.host}")
+
+        params = dict(re.findall(r'(\w+)="([^"]*)"', challenge))
+        realm = params.pop("realm", None)
+        if realm is None:
+            raise RegistryException(f"missing realm for {self.host}")
+
+        params.setdefault("scope", f"repository:{self.repository}:pull")
+
+        try:
+            with urllib.request.urlopen(
+                f"{realm}?{urllib.parse.urlencode(params)}", timeout=60
+            ) as response:
+                body = json.load(response)
+        except (OSError, ValueError) as e:
+            raise RegistryException(f"failed to obtain token for {self.host}: {e}")
+
+        self.token = body.get("token") or body.get("access_token") or ""
+
+    def get_manifest(self, reference: str = None) -> dict:
+        """Fetch the image manifest, resolving indexes for this machine.
+
+        Args:
+            reference: Tag or digest to fetch; defaults to the image reference.
+
+        Returns:
+            Dict containing the image manifest.
+        """
+        with self.request(
+            f"manifests/{reference or self.reference}",
+            {"Accept": ", ".join(MANIFEST_MEDIA_TYPES)},
+        ) as response:
+            manifest = json.load(response)
+
+        if manifest.get("mediaType") in INDEX_MEDIA_TYPES or "manifests" in manifest:
+            arch = ARCHITECTURES.get(platform.machine(), platform.machine())
+            for entry in manifest.get("manifests", []):
+                entry_platform = entry.get("platform", {})
+                if (
+                    entry_platform.get("os") == "linux"
+                    and entry_platform.get("architecture") == arch
+                ):
+                    return self.get_manifest(entry["digest"])
+            raise RegistryException(f"no manifest for linux/{arch}")
+
+        return manifest
+
+    def fetch_blob(self, digest: str, fileobj, offset: int = 0) -> None:
+        """Download a blob, resuming from an offset where possible.
+
+        Args:
+            digest: Digest of the blob.
+            fileobj: Binary file object positioned at offset to write to.
+            offset: Number of bytes already present in fileobj.
+
+        Raises:
+            IncompleteBlobException: The transfer was interrupted; whatever
+                was written to fileobj is valid and can be resumed from.
+        """
+        headers = {"Range": f"bytes={offset}-"} if offset else {}
+
+        with self.request(f"blobs/{digest}", headers) as response:
+            if offset and response.status != 206:
+                # Range not honoured, start over
+                fileobj.seek(0)
+                fileobj.truncate()
+
+            started = time.monotonic()
+            transferred = 0
+
+            try:
+                while chunk := response.read(1024 * 1024):
+                    fileobj.write(chunk)
+                    transferred += len(chunk)
+                    if self.rate_limit:
+                        delay = transferred / self.rate_limit - (
+                            time.monotonic() - started
+                        )
+                        if delay > 0:
+                            time.sleep(delay)
+            except (OSError, http.client.HTTPException) as e:
+                raise IncompleteBlobException(f"transfer of {digest} interrupted: {e}")
@@ -2,6 +2,35 @@ import os
 import subprocess
 
 from classes.exceptions import UnsupportedPkgManagerException
+from utils.manifest import hash_file, hash_files
+
+
+class Kernel:
+    """Describes a kernel shipped in a root filesystem.
+
+    Attributes:
+        version: A string containing the kernel version.
+        image_path: A string containing the path to the kernel image.
+        size: Size of the kernel image in bytes.
+        sha256: A string containing the SHA-256 digest of the kernel image.
+    """
+
+    def __init__(self, version: str, image_path: str, size: int, sha256: str) -> None:
+        """Initialises the instance based on a kernel image.
+
+        Args:
+            version: Kernel version.
+            image_path: Path to the kernel image.
+            size: Size of the kernel image in bytes.
+            sha256: SHA-256 digest of the kernel image.
+        """
+        self.version = version
+        self.image_path = image_path
+        self.size = size
+        self.sha256 = sha256
+
+    def __repr__(self) -> str:
+        return self.version
 
 
 class RootFS:
@@ -39,33 +68,133 @@ class RootFS:
             **kwargs,
         )
 
-    def copy_kernels_to_boot(self) -> None:
-        """Copy any found kernels to /boot within rootfs."""
-        kernels = [
-            kernel
-            for kernel in os.listdir(f"{self.rootfs_path}/usr/lib/modules")
-            if self.exists(f"/usr/lib/modules/{kernel}/vmlinuz")
+    def kernel_inventory(self) -> list:
+        """Find kernels within rootfs.
+
+        Versions are taken from /usr/lib/modules; the image of each is
+        /usr/lib/modules/<version>/vmlinuz, or /boot/vmlinuz-<version> as
+        shipped by apt-based images.
+
+        Returns:
+            A list of Kernel instances, one per kernel found.
+        """
+        modules_dir = os.path.join(self.rootfs_path, "usr/lib/modules")
+
+        if not os.path.isdir(modules_dir):
+            return []
+
+        image_paths = {}
+        for version in sorted(os.listdir(modules_dir)):
+            for image_path in [
+                os.path.join(modules_dir, version, "vmlinuz"),
+                os.path.join(self.rootfs_path, "boot", f"vmlinuz-{version}"),
+            ]:
+                if os.path.isfile(image_path):
+                    image_paths[version] = image_path
+                    break
+
+        return [
+            Kernel(version, image_path, os.path.getsize(image_path), sha256)
+            for (version, image_path), sha256 in zip(
+                image_paths.items(), hash_files(list(image_paths.values()))
+            )
         ]
 
-        if len(kernels) == 0:
+    def kernel_supports_erofs(self, kernel: Kernel) -> bool:
+        """Check if a kernel can mount LZ4-compressed EROFS images over loop.
+
+        Args:
+            kernel: A Kernel instance from kernel_inventory().
+
+        Returns:
+            True if erofs and loop are available, as modules or built in, and
+            the kernel config, where shipped, enables compressed EROFS.
+        """
+        for module in ["erofs", "loop"]:
+            if (
+                subprocess.run(
+                    ["modinfo", "-b", self.rootfs_path, "-k", kernel.version, module],
+                    stdout=subprocess.DEVNULL,
+                    stderr=subprocess.DEVNULL,
+                ).returncode
+                != 0
+            ):
+                return False
+
+        for config_path in [
+            os.path.join(self.rootfs_path, "usr/lib/modules", kernel.version, "config"),
+            os.path.join(self.rootfs_path, "boot", f"config-{kernel.version}"),
+        ]:
+            if os.path.isfile(config_path):
+                with open(config_path) as f:
+                    return "CONFIG_EROFS_FS_ZIP=y" in f.read().splitlines()
+
+        return True
+
+    def copy_kernels_to_boot(self, kernels: list) -> None:
+        """Copy kernels to /boot within rootfs.
+
+        Kernel images the image already ships in /boot are kept; any other
+        files are removed. Nothing is changed if no kernel has its image in
+        /usr/lib/modules.
+
+        Args:
+            kernels: A list of Kernel instances from kernel_inventory().
+
+        Raises:
+            OSError: A kernel image could not be copied intact.
+        """
+        boot_dir = os.path.join(self.rootfs_path, "boot")
+
+        if all(os.path.dirname(kernel.image_path) == boot_dir for kernel in kernels):
             return
 
-        for boot_file in os.listdir(f"{self.rootfs_path}/boot"):
-            if not os.path.isdir(boot_file):
-                self.exec("rm", "-f", f"/boot/{boot_file}")
+        boot_kernels = {f"vmlinuz-{kernel.version}": kernel for kernel in kernels}
 
-        for kernel in kernels:
-            self.exec(
-                "cp",
-                f"/usr/lib/modules/{kernel}/vmlinuz",
-                f"/boot/vmlinuz-{kernel}",
-                stdout=subprocess.DEVNULL,
-                stderr=subprocess.DEVNULL,
-            )
+        for boot_file in os.listdir(boot_dir):
+            boot_path = os.path.join(boot_dir, boot_file)
 
-    def generate_initramfs(self) -> None:
-        """Generate initramfs within rootfs."""
-        self.exec("dracut", "--force", "--regenerate-all")
+            if os.path.isdir(boot_path) and not os.path.islink(boot_path):
+                continue
+
+            if (
+                (kernel := boot_kernels.get(boot_file)) is not None
+                and not os.path.islink(boot_path)
+                and os.path.getsize(boot_path) == kernel.size
+                and hash_file(boot_path) == kernel.sha256
+            ):
+                continue
+
+            os.remove(boot_path)
+
+        for boot_file, kernel in boot_kernels.items():
+            boot_path = os.path.join(boot_dir, boot_file)
+
+            if os.path.exists(boot_path):
+                continue
+
+            if (
+                subprocess.run(
+                    ["cp", "--reflink=auto", kernel.image_path, boot_path]
+                ).returncode
+                != 0
+                or os.path.getsize(boot_path) != kernel.size
+                or hash_file(boot_path) != kernel.sha256
+            ):
+                raise OSError(f"failed to copy kernel {kernel.version} to {boot_path}")
+
+    def generate_initramfs(self, kernels: list) -> None:
+        """Generate initramfs within rootfs.
+
+        Args:
+            kernels: A list of Kernel instances from kernel_inventory();
+                if empty, dracut looks for kernels itself.
+        """
+        if len(kernels) == 0:
+            self.exec("dracut", "--force", "--regenerate-all")
+
+        for kernel in kernels:
+            self.exec("dracut", "--force", "--kver", kernel.version)
 
     def __repr__(self) -> str:
         return self.rootfs_path
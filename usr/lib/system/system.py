@@ -1,14 +1,17 @@
 #!/usr/bin/python3
 
 import os
+import signal
 import subprocess
 import sys
 import time
 
 import click
-import fasteners
-from utils import helpers, output
-from utils.rebase import rebase
+from classes import exceptions
+from classes.lock import SystemLock
+from utils import helpers, manifest, output
+from utils.rebase import rebase, restore_boot_files
+from utils.rollback import rollback
 
 
 @click.group("cli")
@@ -34,12 +37,41 @@ def update_check_daemon():
     if isinstance(helpers.get_system_config().get("auto-update-interval"), int):
         check_interval = helpers.get_system_config()["auto-update-interval"]
 
+    auto_prefetch = helpers.get_system_config().get("auto-prefetch") is not False
+    prefetched_revision = None
+    prefetch = None
+    prefetch_revision = None
+
     while True:
         try:
             if not os.path.isdir("/.update_rootfs"):
                 system_config = helpers.get_system_config()
 
                 if not helpers.is_already_latest(system_config["image"]):
+                    if auto_prefetch:
+                        revision = (
+                            helpers.fetch_image_metadata(system_config["image"]).get(
+                                "Labels"
+                            )
+                            or {}
+                        ).get("org.opencontainers.image.revision")
+
+                        # Failed prefetches are tried again at the next check
+                        if prefetch is not None and prefetch.poll() is not None:
+                            if prefetch.returncode == 0:
+                                prefetched_revision = prefetch_revision
+                            prefetch = None
+
+                        # Runs alongside the prompt below, without a password
+                        # thanks to the polkit rule shipped with this package
+                        if revision != prefetched_revision and prefetch is None:
+                            prefetch = subprocess.Popen(
+                                ["pkexec", "/usr/bin/system", "prefetch", "--idle"],
+                                stdout=subprocess.DEVNULL,
+                                stderr=subprocess.DEVNULL,
+                            )
+                            prefetch_revision = revision
+
                     if helpers.notify_prompt(
                         title="Update available",
                         body="A system update is available",
@@ -66,7 +98,9 @@ def update_check_daemon():
 
 @cli.command("update")
 @click.option("-f", "--force", is_flag=True)
-def update_cmd(force):
+@click.option("--no-wait", is_flag=True)
+@click.option("--timeout", type=float)
+def update_cmd(force, no_wait, timeout):
     """
     Update your system to the latest available image.
     """
@@ -75,11 +109,12 @@ def update_cmd(force):
         output.error("must be run as root")
         exit(1)
 
-    system_lock = fasteners.InterProcessLock("/var/lib/commonarch/.system-lock")
-    output.info("attempting to acquire system lock")
-    output.info("if stuck for long, an update may be progressing in the background")
+    # The update resumes the download of a running prefetch
+    helpers.preempt_lock_holder("prefetch")
 
-    with system_lock:
+    with helpers.acquire_system_lock(
+        "update", timeout=0 if no_wait else timeout
+    ) as system_lock:
         print()
         output.info("checking if already up-to-date...")
 
@@ -96,14 +131,230 @@ def update_cmd(force):
             output.error("you must reboot before running this command")
             sys.exit(1)
 
-        rebase(system_config["image"])
+        rebase(system_config["image"], system_lock)
         output.info("update complete; you may now reboot.")
 
 
+@cli.command("prefetch")
+@click.option("--idle", is_flag=True)
+@click.option("--no-wait", is_flag=True)
+@click.option("--timeout", type=float)
+def prefetch_cmd(idle, no_wait, timeout):
+    """
+    Download the latest available image without applying it.
+    """
+
+    if os.geteuid() != 0:
+        output.error("must be run as root")
+        exit(1)
+
+    if idle:
+        helpers.set_idle_priority()
+
+    # Stopped by 'system update' taking over; exiting releases the lock
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(1))
+
+    with helpers.acquire_system_lock(
+        "prefetch", timeout=0 if no_wait else timeout
+    ) as system_lock:
+        print()
+        output.info("checking if already up-to-date...")
+
+        system_config = helpers.get_system_config()
+
+        if helpers.is_already_latest(system_config["image"]):
+            output.info("your system is already up-to-date")
+            sys.exit(0)
+
+        output.info("prefetching image")
+        system_lock.update(phase="prefetching image")
+
+        try:
+            transferred = helpers.prefetch_image(
+                system_config["image"],
+                rate_limit=helpers.get_rate_limit(system_config),
+                progress=lambda fraction: system_lock.update(progress=fraction),
+            )
+        except exceptions.ImageMetadataException:
+            output.error(f"failed to prefetch image {system_config['image']}")
+            sys.exit(1)
+
+        if transferred >= 0:
+            output.info(f"prefetch complete; downloaded {transferred} bytes")
+        else:
+            output.info("prefetch complete")
+
+
+@cli.command("verify")
+@click.option("--full", is_flag=True)
+def verify_cmd(full):
+    """
+    Verify the integrity of a downloaded update.
+    """
+
+    if os.geteuid() != 0:
+        output.error("must be run as root")
+        exit(1)
+
+    with helpers.acquire_system_lock("verify", exclusive=False, timeout=0):
+        print()
+
+        if not os.path.isdir("/.update_rootfs"):
+            problems = []
+            output.info("no update is waiting to be applied")
+        elif manifest.is_legacy("/.update_rootfs"):
+            problems = []
+            output.info("the downloaded update was staged without a manifest")
+            output.info("it will be applied at the next boot without verification")
+        else:
+            output.info("verifying downloaded update...")
+            problems = manifest.check_stage("/.update_rootfs", full=full)
+
+    refused_boot_files = os.path.isdir("/.failed.update_rootfs/.previous-boot")
+
+    if problems or refused_boot_files:
+        # Putting back boot files and clearing the mark change the system
+        with helpers.acquire_system_lock("verify", timeout=0):
+            # Refused at boot before its boot files could be put back
+            if os.path.isdir("/.failed.update_rootfs/.previous-boot"):
+                output.warn("restoring boot files replaced by a refused update")
+                restore_boot_files("/.failed.update_rootfs")
+
+            # Checked again, as the update may have changed in the meantime
+            if (
+                problems
+                and os.path.isdir("/.update_rootfs")
+                and not manifest.is_legacy("/.update_rootfs")
+            ):
+                problems = manifest.check_stage("/.update_rootfs", full=full)
+            else:
+                problems = []
+
+            if problems:
+                manifest.clear_verified("/.update_rootfs")
+                restore_boot_files()
+                for problem in problems:
+                    output.error(problem)
+                output.error("the downloaded update is damaged and will not be applied")
+                output.error("run 'system update --force' to download it again")
+                sys.exit(1)
+
+    if os.path.isdir("/.update_rootfs") and not manifest.is_legacy("/.update_rootfs"):
+        output.info("the downloaded update is intact")
+
+
+@cli.command("status")
+def status_cmd():
+    """
+    Show the state of the system and of any running operation.
+    """
+
+    output.info(f"current revision: {helpers.get_revision() or 'unknown'}")
+
+    if os.path.isfile("/var/lib/commonarch/previous-revision"):
+        with open("/var/lib/commonarch/previous-revision") as previous_revision_file:
+            output.info(f"previous revision: {previous_revision_file.read().strip()}")
+
+    if os.path.isdir("/.update_rootfs"):
+        output.info(
+            f"pending revision: {helpers.get_revision('/.new.var.lib') or 'unknown'}"
+            + (
+                ""
+                if manifest.will_be_applied("/.update_rootfs")
+                else " (will not be applied)"
+            )
+        )
+
+    system_lock = SystemLock("status")
+    holder = system_lock.read_holder()
+
+    try:
+        acquired = system_lock.acquire(exclusive=False, timeout=0)
+    except OSError:
+        # The lock file is only writable by root; go by the holder metadata
+        if holder is None:
+            output.info("system lock: free or held by a read-only command")
+        elif system_lock.is_stale(holder):
+            output.warn(f"stale lock information left by pid {holder['pid']}")
+            output.info("system lock: free or held by a read-only command")
+        else:
+            output.info(f"system lock: held by {helpers.describe_lock_holder(holder)}")
+        return
+
+    if acquired:
+        system_lock.release()
+        if holder is not None:
+            output.warn(f"stale lock information left by pid {holder['pid']}")
+        output.info("system lock: free")
+    elif holder is None or system_lock.is_stale(holder):
+        output.info("system lock: held by a read-only command")
+    else:
+        output.info(f"system lock: held by {helpers.describe_lock_holder(holder)}")
+
+
+@cli.command("list-updates")
+@click.argument("image_names", nargs=-1)
+def list_updates_cmd(image_names):
+    """
+    Compare available images with the current system.
+    """
+
+    try:
+        # An empty system.yaml parses to None
+        system_config = helpers.get_system_config() or {}
+    except exceptions.SystemFileException:
+        system_config = {}
+
+    candidates = [system_config["image"]] if "image" in system_config else []
+    if isinstance((update_candidates := system_config.get("update-candidates")), list):
+        candidates += update_candidates
+    candidates += image_names
+
+    # Preserve order, drop duplicates
+    candidates = list(dict.fromkeys(candidates))
+
+    if len(candidates) == 0:
+        output.error("no images to check")
+        exit(1)
+
+    max_age = system_config.get("metadata-cache-ttl")
+    images_metadata = helpers.fetch_images_metadata(
+        candidates, max_age=max_age if isinstance(max_age, int) else 300
+    )
+    current_revision = helpers.get_revision()
+
+    rows = [["IMAGE", "REVISION", "CREATED", "DOWNLOAD", ""]]
+    for image_name, metadata in images_metadata.items():
+        if metadata is None:
+            rows.append([image_name, "-", "-", "-", "unavailable"])
+            continue
+
+        revision = (metadata.get("Labels") or {}).get(
+            "org.opencontainers.image.revision"
+        )
+        download_size = helpers.get_download_size(metadata)
+
+        rows.append(
+            [
+                image_name,
+                revision or "-",
+                (metadata.get("Created") or "-")[:16].replace("T", " "),
+                "-" if download_size is None else helpers.format_size(download_size),
+                "current" if revision and revision == current_revision else "",
+            ]
+        )
+
+    widths = [max(len(row[i]) for row in rows) for i in range(len(rows[0]))]
+    for row in rows:
+        print("  ".join(cell.ljust(width) for cell, width in zip(row, widths)).rstrip())
+
+
 @cli.command("rebase")
 @click.argument("image_name", nargs=1, required=True)
 @click.option("-f", "--force", is_flag=True)
-def rebase_cmd(image_name, force):
+@click.option("--no-wait", is_flag=True)
+@click.option("--timeout", type=float)
+def rebase_cmd(image_name, force, no_wait, timeout):
     """
     Switch to a different OS image.
     """
@@ -112,11 +363,9 @@ def rebase_cmd(image_name, force):
         output.error("must be run as root")
         exit(1)
 
-    system_lock = fasteners.InterProcessLock("/var/lib/commonarch/.system-lock")
-    output.info("attempting to acquire system lock")
-    output.info("if stuck for long, an update may be progressing in the background")
-
-    with system_lock:
+    with helpers.acquire_system_lock(
+        "rebase", timeout=0 if no_wait else timeout
+    ) as system_lock:
         print()
         output.info("checking if already up-to-date...")
 
@@ -133,9 +382,47 @@ def rebase_cmd(image_name, force):
             output.error("you must reboot before running this command")
             sys.exit(1)
 
-        rebase(image_name)
+        rebase(image_name, system_lock)
         output.info("update complete; you may now reboot.")
 
 
+@cli.command("rollback")
+@click.option("-f", "--force", is_flag=True)
+@click.option("--no-wait", is_flag=True)
+@click.option("--timeout", type=float)
+def rollback_cmd(force, no_wait, timeout):
+    """
+    Return to the system as it was before the last update.
+
+    /etc and /var/lib are also returned to their state at the last update,
+    losing any later changes to them, e.g. passwords, users, and container
+    or flatpak data. Asks for confirmation unless --force is given, which
+    also discards an update waiting to be applied.
+    """
+
+    if os.geteuid() != 0:
+        output.error("must be run as root")
+        exit(1)
+
+    if not force:
+        output.warn("changes to /etc and /var/lib since the last update will be lost")
+        output.warn("this includes passwords, users, and container or flatpak data")
+        if not click.confirm("roll back anyway?"):
+            sys.exit(1)
+
+    with helpers.acquire_system_lock("rollback", timeout=0 if no_wait else timeout):
+        print()
+
+        if os.path.isdir("/.update_rootfs") and not force:
+            output.error(
+                "an update has already been downloaded and is waiting to be applied"
+            )
+            output.error("you must reboot before running this command")
+            sys.exit(1)
+
+        rollback()
+        output.info("rollback complete; you may now reboot.")
+
+
 if __name__ == "__main__":
     main()
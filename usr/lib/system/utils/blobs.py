@@ -0,0 +1,154 @@
+import hashlib
+import os
+
+from classes.exceptions import IncompleteBlobException, RegistryException
+from classes.registry import Registry
+from utils import output
+
+BLOB_DIR = "/var/lib/commonarch/blobs"
+PARTIAL_DIR = "/var/lib/commonarch/partial-blobs"
+
+# Attempts per blob when a transfer is cut short
+RETRIES = 5
+
+
+def blob_path(digest: str, blob_dir: str = None) -> str:
+    """Get the location of a blob within the shared blob store.
+
+    Args:
+        digest: Digest of the blob, e.g. "sha256:abcd...".
+        blob_dir: Path to the shared blob store; BLOB_DIR if not given.
+
+    Returns:
+        String containing the path to the blob.
+    """
+    algorithm, _, encoded = digest.partition(":")
+    return os.path.join(blob_dir or BLOB_DIR, algorithm, encoded)
+
+
+def verify_blob(path: str, digest: str) -> bool:
+    """Check if a file matches a digest.
+
+    Args:
+        path: Path to the file.
+        digest: Expected digest, e.g. "sha256:abcd...".
+
+    Returns:
+        True if the file content matches the digest; otherwise False.
+    """
+    algorithm, _, encoded = digest.partition(":")
+
+    try:
+        hasher = hashlib.new(algorithm)
+        with open(path, "rb") as f:
+            while chunk := f.read(1024 * 1024):
+                hasher.update(chunk)
+    except (OSError, ValueError):
+        return False
+
+    return hasher.hexdigest() == encoded
+
+
+def image_blobs(registry: Registry) -> list:
+    """List the blobs making up an image.
+
+    Args:
+        registry: An instance of Registry for the image.
+
+    Returns:
+        A list of (digest, size) tuples for the config and layer blobs.
+    """
+    manifest = registry.get_manifest()
+
+    return [
+        (descriptor["digest"], descriptor.get("size"))
+        for descriptor in [manifest["config"], *manifest["layers"]]
+    ]
+
+
+def fetch_blob(registry: Registry, digest: str, size: int = None) -> int:
+    """Checkpointed download of a single blob into the shared blob store.
+
+    Completed blobs are kept and only re-downloaded if they no longer match
+    their digest; partial downloads are resumed with a range request.
+
+    Args:
+        registry: An instance of Registry for the image.
+        digest: Digest of the blob.
+        size: Expected size of the blob in bytes, if known.
+
+    Returns:
+        Number of bytes transferred.
+
+    Raises:
+        IncompleteBlobException: The transfer was cut short; the bytes
+            received are kept and counted in its transferred attribute.
+    """
+    final_path = blob_path(digest)
+
+    if os.path.isfile(final_path):
+        if verify_blob(final_path, digest):
+            return 0
+        output.warn(f"blob {digest} is corrupted; downloading again")
+        os.remove(final_path)
+
+    os.makedirs(os.path.dirname(final_path), exist_ok=True)
+    os.makedirs(PARTIAL_DIR, exist_ok=True)
+    partial_path = os.path.join(PARTIAL_DIR, digest.replace(":", "-"))
+
+    offset = os.path.getsize(partial_path) if os.path.isfile(partial_path) else 0
+    if size is not None and offset > size:
+        offset = 0
+
+    with open(partial_path, "ab" if offset else "wb") as f:
+        try:
+            if size is None or offset < size:
+                registry.fetch_blob(digest, f, offset)
+        except IncompleteBlobException as e:
+            raise IncompleteBlobException(str(e), f.tell() - offset) from e
+        transferred = f.tell() - offset
+
+        # Kept for the next attempt to resume from
+        if size is not None and f.tell() < size:
+            raise IncompleteBlobException(
+                f"blob {digest} incomplete ({f.tell()} of {size} bytes)", transferred
+            )
+
+    if not verify_blob(partial_path, digest):
+        os.remove(partial_path)
+        raise RegistryException(f"blob {digest} does not match its digest")
+
+    os.replace(partial_path, final_path)
+
+    return max(transferred, 0)
+
+
+def fetch_blobs(image_name: str, rate_limit: int = None, progress=None) -> int:
+    """Fetch all blobs of an image into the shared blob store.
+
+    Args:
+        image_name: Image to fetch blobs for.
+        rate_limit: Maximum transfer rate in bytes per second.
+        progress: Optional callable receiving the fraction of blobs fetched.
+
+    Returns:
+        Number of bytes transferred.
+    """
+    registry = Registry(image_name, rate_limit=rate_limit)
+    transferred = 0
+
+    descriptors = image_blobs(registry)
+    for i, (digest, size) in enumerate(descriptors):
+        for attempt in range(RETRIES):
+            try:
+                transferred += fetch_blob(registry, digest, size)
+                break
+            except IncompleteBlobException as e:
+                transferred += e.transferred
+                if attempt == RETRIES - 1:
+                    raise
+                output.warn(f"{e}; resuming")
+        if progress is not None:
+            progress((i + 1) / len(descriptors))
+
+    return transferred
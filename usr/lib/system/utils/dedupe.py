@@ -0,0 +1,204 @@
+import contextlib
+import json
+import os
+import stat
+import subprocess
+
+from utils import manifest
+
+SYSROOT = "/run/commonarch/sysroot"
+
+# Bounds the number of same-sized files hashed per new file
+MAX_CANDIDATES = 4
+
+
+@contextlib.contextmanager
+def live_root():
+    """Expose the root filesystem without the overlays mounted on top of it.
+
+    A non-recursive bind mount of / shows the real /usr directory, and keeps
+    it on the same mount as /.update_rootfs so files can be hardlinked.
+
+    Yields:
+        Path to the bind mount, or None if it could not be set up.
+    """
+    os.makedirs(SYSROOT, exist_ok=True)
+
+    if subprocess.run(["mount", "--bind", "/", SYSROOT]).returncode != 0:
+        yield None
+        return
+
+    try:
+        yield SYSROOT
+    finally:
+        subprocess.run(["umount", SYSROOT])
+
+
+def index_tree(root: str, subdir: str = "usr") -> dict:
+    """Stat every regular file below a subdirectory of a tree.
+
+    Args:
+        root: Path to the tree.
+        subdir: Subdirectory to index.
+
+    Returns:
+        Dict mapping paths relative to root to their lstat results.
+    """
+    files = {}
+
+    for dirpath, _, filenames in os.walk(os.path.join(root, subdir)):
+        for name in filenames:
+            path = os.path.join(dirpath, name)
+            st = os.lstat(path)
+            if stat.S_ISREG(st.st_mode) and st.st_size:
+                files[os.path.relpath(path, root)] = st
+
+    return files
+
+
+def load_cached_hashes(root: str, files: dict) -> dict:
+    """Reuse checksums from the manifest of the stage that became /usr.
+
+    Args:
+        root: Path to the live root filesystem.
+        files: Dict of live files as returned by index_tree().
+
+    Returns:
+        Dict mapping paths relative to root to checksums still valid.
+    """
+    try:
+        with open(
+            os.path.join(root, ".old.update_rootfs", manifest.MANIFEST_NAME)
+        ) as f:
+            old_manifest = json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+    return {
+        rel_path: entry["sha256"]
+        for rel_path, entry in old_manifest.items()
+        if rel_path in files
+        and "sha256" in entry
+        and entry.get("size") == files[rel_path].st_size
+        and entry.get("mtime_ns") == files[rel_path].st_mtime_ns
+    }
+
+
+def same_metadata(path_a: str, st_a, path_b: str, st_b) -> bool:
+    """Check if two files could share an inode without visible changes.
+
+    Args:
+        path_a: Path to the first file.
+        st_a: lstat result of the first file.
+        path_b: Path to the second file.
+        st_b: lstat result of the second file.
+    """
+    # mtime included, as caches such as .pyc files are keyed on it
+    if (st_a.st_size, st_a.st_mtime_ns, st_a.st_mode, st_a.st_uid, st_a.st_gid) != (
+        st_b.st_size,
+        st_b.st_mtime_ns,
+        st_b.st_mode,
+        st_b.st_uid,
+        st_b.st_gid,
+    ):
+        return False
+
+    try:
+        return {name: os.getxattr(path_a, name) for name in os.listxattr(path_a)} == {
+            name: os.getxattr(path_b, name) for name in os.listxattr(path_b)
+        }
+    except OSError:
+        return False
+
+
+def find_duplicates(new_root: str, live_root: str) -> list:
+    """Match files of a new rootfs against identical files of the live /usr.
+
+    Files are paired by path first and by size otherwise, then compared by
+    content hash.
+
+    Args:
+        new_root: Path to the new rootfs.
+        live_root: Path to the live root filesystem.
+
+    Returns:
+        A list of (new path, live path, size) tuples, relative to the roots.
+    """
+    new_files = index_tree(new_root)
+    live_files = index_tree(live_root)
+
+    live_by_size = {}
+    for rel_path, st in live_files.items():
+        live_by_size.setdefault(st.st_size, []).append(rel_path)
+
+    candidates = {}
+    for rel_path, st in new_files.items():
+        paths = [rel_path] if rel_path in live_files else []
+        paths += [
+            p
+            for p in live_by_size.get(st.st_size, [])[:MAX_CANDIDATES]
+            if p != rel_path
+        ]
+        candidates[rel_path] = [
+            p
+            for p in paths
+            if same_metadata(
+                os.path.join(new_root, rel_path),
+                st,
+                os.path.join(live_root, p),
+                live_files[p],
+            )
+        ]
+
+    hashes = {
+        ("live", p): h for p, h in load_cached_hashes(live_root, live_files).items()
+    }
+    to_hash = sorted(
+        (
+            {("new", p) for p, c in candidates.items() if c}
+            | {("live", p) for c in candidates.values() for p in c}
+        )
+        - hashes.keys()
+    )
+    for key, digest in zip(
+        to_hash,
+        manifest.hash_files(
+            [os.path.join(new_root if k == "new" else live_root, p) for k, p in to_hash]
+        ),
+    ):
+        hashes[key] = digest
+
+    duplicates = []
+    for rel_path, paths in candidates.items():
+        for p in paths:
+            if hashes[("new", rel_path)] == hashes[("live", p)]:
+                duplicates.append((rel_path, p, new_files[rel_path].st_size))
+                break
+
+    return duplicates
+
+
+def link_duplicates(live_root: str, stage: str, duplicates: list) -> None:
+    """Recreate deduplicated files in the stage from the live /usr.
+
+    Files are hardlinked, or reflinked where that is not possible.
+
+    Args:
+        live_root: Path to the live root filesystem.
+        stage: Path to the stage relative to the live root filesystem.
+        duplicates: A list of tuples as returned by find_duplicates().
+    """
+    for new_path, live_path, _ in duplicates:
+        source = os.path.join(live_root, live_path)
+        target = os.path.join(live_root, stage.lstrip("/"), new_path)
+
+        try:
+            os.link(source, target)
+        except OSError:
+            if (
+                subprocess.run(
+                    ["cp", "-a", "--reflink=auto", "--", source, target]
+                ).returncode
+                != 0
+            ):
+                raise OSError(f"failed to copy {live_path} to {target}")
@@ -1,9 +1,15 @@
+import concurrent.futures
+import hashlib
 import json
 import os
+import signal
 import subprocess
+import time
 
 import yaml
 from classes import exceptions
+from classes.lock import SystemLock
+from utils import blobs, output
 
 
 def get_system_config() -> dict:
@@ -39,8 +45,159 @@ def fetch_image_metadata(image_name: str) -> dict:
         raise exceptions.ImageMetadataException()
 
 
-def pull_image(image_name) -> None:
-    """Pull the provided image locally."""
+def fetch_cached_image_metadata(image_name: str, max_age: int = 300) -> dict:
+    """Fetch image metadata, reusing a cached copy if fresh enough.
+
+    Args:
+        image_name: Image to check metadata for.
+        max_age: Maximum age of a cached copy in seconds.
+
+    Returns:
+        Dict containing image metadata.
+    """
+    cache_path = os.path.join(
+        "/var/cache/commonarch/metadata",
+        hashlib.sha256(image_name.encode()).hexdigest() + ".json",
+    )
+
+    try:
+        if time.time() - os.path.getmtime(cache_path) < max_age:
+            with open(cache_path) as cache_file:
+                return json.load(cache_file)
+    except (OSError, ValueError):
+        pass
+
+    metadata = fetch_image_metadata(image_name)
+
+    try:
+        os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+        with open(f"{cache_path}.tmp", "w") as cache_file:
+            json.dump(metadata, cache_file)
+        os.replace(f"{cache_path}.tmp", cache_path)
+    except OSError:
+        pass
+
+    return metadata
+
+
+def fetch_images_metadata(
+    image_names: list, max_age: int = 300, max_workers: int = 8
+) -> dict:
+    """Fetch metadata of several images concurrently.
+
+    Args:
+        image_names: List of images to check metadata for.
+        max_age: Maximum age of cached copies in seconds.
+        max_workers: Maximum number of concurrent queries.
+
+    Returns:
+        Dict mapping each image to its metadata, or None if unavailable.
+    """
+
+    def fetch(image_name):
+        try:
+            return fetch_cached_image_metadata(image_name, max_age)
+        except (exceptions.ImageMetadataException, OSError):
+            return None
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers) as executor:
+        return dict(zip(image_names, executor.map(fetch, image_names)))
+
+
+def get_download_size(metadata: dict) -> int:
+    """Compute how much of an image is missing from the shared blob store.
+
+    Args:
+        metadata: Dict containing image metadata.
+
+    Returns:
+        Size in bytes still to be downloaded, or None if unknown.
+    """
+    if not isinstance((layers := metadata.get("LayersData")), list):
+        return None
+
+    return sum(
+        layer.get("Size", 0)
+        for layer in layers
+        if not os.path.isfile(blobs.blob_path(layer["Digest"]))
+    )
+
+
+def get_rate_limit(system_config: dict):
+    """Retrieve the configured download rate limit.
+
+    Args:
+        system_config: Dict containing system config.
+
+    Returns:
+        Maximum transfer rate in bytes per second, or None if unlimited.
+    """
+    rate_limit = system_config.get("download-rate-limit")
+
+    return rate_limit * 1024 if isinstance(rate_limit, int) else None
+
+
+def set_idle_priority() -> None:
+    """Lower CPU and I/O priority of this process and its children."""
+    os.nice(19)
+    subprocess.run(["ionice", "-c", "3", "-p", str(os.getpid())])
+
+
+def prefetch_image(image_name, rate_limit: int = None, progress=None) -> int:
+    """Download the blobs of the provided image into the shared blob store.
+
+    Unlike pull_image(), nothing is unpacked.
+
+    Args:
+        image_name: Image to prefetch.
+        rate_limit: Maximum transfer rate in bytes per second.
+        progress: Optional callable receiving the fraction of blobs fetched.
+
+    Returns:
+        Number of bytes transferred, or -1 if unknown.
+    """
+    try:
+        return blobs.fetch_blobs(image_name, rate_limit=rate_limit, progress=progress)
+    except exceptions.RegistryException as e:
+        output.warn(f"checkpointed download unavailable: {e}")
+
+    try:
+        if (
+            subprocess.run(
+                [
+                    "skopeo",
+                    "copy",
+                    image_name,
+                    "--dest-shared-blob-dir=/var/lib/commonarch/blobs",
+                    "oci:/var/lib/commonarch/prefetch-image:main",
+                ]
+            ).returncode
+            != 0
+        ):
+            raise exceptions.ImageMetadataException()
+    finally:
+        subprocess.run(["rm", "-rf", "/var/lib/commonarch/prefetch-image"])
+
+    return -1
+
+
+def pull_image(image_name, rate_limit: int = None, progress=None) -> None:
+    """Pull the provided image locally.
+
+    Blobs are first fetched into the shared blob store with checkpointing, so
+    that an interrupted pull only transfers what is still missing; skopeo then
+    reuses them and falls back to a full transfer for anything left over.
+
+    Args:
+        image_name: Image to pull.
+        rate_limit: Maximum transfer rate in bytes per second.
+        progress: Optional callable receiving the fraction of blobs fetched.
+    """
+    try:
+        blobs.fetch_blobs(image_name, rate_limit=rate_limit, progress=progress)
+    except exceptions.RegistryException as e:
+        output.warn(f"checkpointed download unavailable: {e}")
+
     if not (
         (
             subprocess.run(
@@ -87,6 +244,23 @@ def pull_image(image_name) -> None:
         raise exceptions.ImageMetadataException()
 
 
+def get_revision(var_lib: str = "/var/lib") -> str:
+    """Read the revision recorded in a /var/lib tree.
+
+    Args:
+        var_lib: Path to the /var/lib tree.
+
+    Returns:
+        String containing the revision, or None if not recorded.
+    """
+
+    if os.path.isfile(f"{var_lib}/commonarch/revision"):
+        with open(f"{var_lib}/commonarch/revision") as revision_file:
+            return revision_file.read().strip()
+
+    return None
+
+
 def is_already_latest(image_name: str) -> bool:
     """Check if already on the latest revision.
 
@@ -97,10 +271,7 @@ def is_already_latest(image_name: str) -> bool:
         True if there is no update available; otherwise False.
     """
 
-    if os.path.isfile("/var/lib/commonarch/revision"):
-        with open("/var/lib/commonarch/revision") as current_revision_file:
-            current_revision = current_revision_file.read().strip()
-    else:
+    if (current_revision := get_revision()) is None:
         return False
 
     return (
@@ -111,6 +282,117 @@ def is_already_latest(image_name: str) -> bool:
     )
 
 
+def format_size(size: int) -> str:
+    """Format a size in bytes for display.
+
+    Args:
+        size: Size in bytes.
+
+    Returns:
+        String containing the size with a binary unit suffix.
+    """
+    for unit in ["B", "KiB", "MiB", "GiB"]:
+        if size < 1024:
+            break
+        size /= 1024
+    else:
+        unit = "TiB"
+
+    return f"{size:.0f} {unit}" if unit == "B" else f"{size:.1f} {unit}"
+
+
+def describe_lock_holder(holder: dict) -> str:
+    """Describe the holder of the system lock for display.
+
+    Args:
+        holder: Dict containing holder metadata.
+
+    Returns:
+        String describing the holder.
+    """
+    description = f"pid {holder['pid']} (system {holder['command']})"
+
+    if holder.get("phase"):
+        description += f", {holder['phase']}"
+        if holder.get("progress") is not None:
+            description += f" ({holder['progress']:.0%})"
+
+    started = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(holder["started"]))
+
+    return f"{description}, since {started}"
+
+
+def acquire_system_lock(
+    command: str, exclusive: bool = True, timeout: float = None
+) -> SystemLock:
+    """Acquire the system lock, reporting who holds it while waiting.
+
+    Args:
+        command: Command acquiring the lock.
+        exclusive: Whether to acquire the write lock rather than a read lock.
+        timeout: Seconds to wait; None waits indefinitely, 0 not at all.
+
+    Returns:
+        The acquired SystemLock.
+    """
+    system_lock = SystemLock(command)
+
+    if system_lock.acquire(exclusive, timeout=0):
+        return system_lock
+
+    holder = system_lock.read_holder()
+    if holder is None:
+        output.info("system lock is held by a read-only command")
+    elif system_lock.is_stale(holder):
+        output.warn(f"ignoring stale lock information left by pid {holder['pid']}")
+    else:
+        output.info(f"system lock is held by {describe_lock_holder(holder)}")
+
+    if timeout == 0:
+        output.error("system lock is busy")
+        exit(1)
+
+    output.info("waiting for system lock...")
+
+    if not system_lock.acquire(exclusive, timeout=timeout):
+        output.error("timed out waiting for system lock")
+        exit(1)
+
+    return system_lock
+
+
+def preempt_lock_holder(command: str, timeout: float = 10) -> None:
+    """Stop a running command holding the system lock, if it is preemptible.
+
+    Meant for background work such as a prefetch, which keeps its progress
+    and would otherwise hold up the command taking over from it.
+
+    Args:
+        command: Command holding the lock that may be stopped.
+        timeout: Seconds to wait for the holder to exit.
+    """
+    system_lock = SystemLock(command)
+    holder = system_lock.read_holder()
+
+    if (
+        holder is None
+        or holder.get("command") != command
+        or system_lock.is_stale(holder)
+    ):
+        return
+
+    output.info(f"stopping {describe_lock_holder(holder)}")
+
+    try:
+        os.kill(holder["pid"], signal.SIGTERM)
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            os.kill(holder["pid"], 0)
+            time.sleep(0.1)
+    except ProcessLookupError:
+        pass
+
+
 def notify_prompt(title: str, body: str, actions: dict):
     """Display a notification prompting the user.
 
@@ -0,0 +1,266 @@
+import concurrent.futures
+import hashlib
+import json
+import mmap
+import os
+import stat
+
+MANIFEST_NAME = ".manifest.json"
+VERIFIED_NAME = ".verified"
+STAGING_NAME = ".staging"
+
+# Swapped with /boot while staging, not at the next boot
+EXCLUDED = ["boot", ".previous-boot", ".new-boot-files"]
+
+
+def hash_file(path: str) -> str:
+    """Compute the SHA-256 digest of a file using a memory-mapped read.
+
+    Args:
+        path: Path to the file.
+
+    Returns:
+        String containing the hex digest.
+    """
+    hasher = hashlib.sha256()
+
+    with open(path, "rb") as f:
+        if os.fstat(f.fileno()).st_size:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+                hasher.update(m)
+
+    return hasher.hexdigest()
+
+
+def hash_files(paths: list) -> list:
+    """Hash files in parallel across all cores.
+
+    hashlib releases the GIL while hashing, so threads are sufficient.
+
+    Args:
+        paths: List of paths to hash.
+
+    Returns:
+        A list of hex digests in the same order as paths.
+    """
+    with concurrent.futures.ThreadPoolExecutor(os.cpu_count()) as executor:
+        return list(executor.map(hash_file, paths))
+
+
+def scan_tree(root: str) -> dict:
+    """Stat every entry of a staged tree.
+
+    Args:
+        root: Path to the tree.
+
+    Returns:
+        Dict mapping paths relative to root to their lstat results.
+    """
+    entries = {}
+
+    for dirpath, dirnames, filenames in os.walk(root):
+        rel_dir = os.path.relpath(dirpath, root)
+
+        if rel_dir == ".":
+            dirnames[:] = [d for d in dirnames if d not in EXCLUDED]
+            filenames = [
+                f
+                for f in filenames
+                if f not in EXCLUDED + [MANIFEST_NAME, VERIFIED_NAME, STAGING_NAME]
+            ]
+
+        for name in dirnames + filenames:
+            rel_path = os.path.normpath(os.path.join(rel_dir, name))
+            entries[rel_path] = os.lstat(os.path.join(dirpath, name))
+
+    return entries
+
+
+def describe(path: str, st: os.stat_result) -> dict:
+    """Build the manifest entry of a path, without its checksum.
+
+    Args:
+        path: Path to the entry.
+        st: lstat result of the entry.
+
+    Returns:
+        Dict containing the manifest entry.
+    """
+    entry = {"mode": st.st_mode, "uid": st.st_uid, "gid": st.st_gid}
+
+    if stat.S_ISREG(st.st_mode):
+        entry["size"] = st.st_size
+        entry["mtime_ns"] = st.st_mtime_ns
+    elif stat.S_ISLNK(st.st_mode):
+        entry["target"] = os.readlink(path)
+
+    return entry
+
+
+def generate_manifest(root: str, checksums: bool = True) -> None:
+    """Write a content manifest of a staged tree to <root>/.manifest.json.
+
+    Args:
+        root: Path to the tree.
+        checksums: Whether to record file checksums; without them, changed
+            files cannot be told apart from corrupted ones.
+    """
+    entries = scan_tree(root)
+    manifest = {
+        rel_path: describe(os.path.join(root, rel_path), st)
+        for rel_path, st in entries.items()
+    }
+
+    if checksums:
+        files = [
+            rel_path for rel_path, st in entries.items() if stat.S_ISREG(st.st_mode)
+        ]
+        for rel_path, digest in zip(
+            files, hash_files([os.path.join(root, f) for f in files])
+        ):
+            manifest[rel_path]["sha256"] = digest
+
+    with open(os.path.join(root, MANIFEST_NAME), "w") as f:
+        json.dump(manifest, f)
+
+
+def verify_manifest(root: str, full: bool = False) -> list:
+    """Check a staged tree against its manifest.
+
+    Files whose size and mtime still match are trusted unless full is set;
+    only the remaining files are hashed.
+
+    Args:
+        root: Path to the tree.
+        full: Whether to hash every file.
+
+    Returns:
+        A list of strings describing each problem found.
+    """
+    try:
+        with open(os.path.join(root, MANIFEST_NAME)) as f:
+            manifest = json.load(f)
+    except (OSError, ValueError):
+        return ["missing or unreadable manifest"]
+
+    entries = scan_tree(root)
+    problems = [f"unexpected: {rel_path}" for rel_path in entries.keys() - manifest]
+    to_hash = []
+
+    for rel_path, expected in manifest.items():
+        if rel_path not in entries:
+            problems.append(f"missing: {rel_path}")
+            continue
+
+        actual = describe(os.path.join(root, rel_path), entries[rel_path])
+
+        if any(
+            actual.get(key) != expected.get(key)
+            for key in ("mode", "uid", "gid", "size", "target")
+        ):
+            problems.append(f"changed: {rel_path}")
+        elif stat.S_ISREG(expected["mode"]) and (
+            full or actual["mtime_ns"] != expected["mtime_ns"]
+        ):
+            if "sha256" in expected:
+                to_hash.append(rel_path)
+            else:
+                problems.append(f"changed: {rel_path}")
+
+    for rel_path, digest in zip(
+        to_hash, hash_files([os.path.join(root, f) for f in to_hash])
+    ):
+        if digest != manifest[rel_path]["sha256"]:
+            problems.append(f"corrupted: {rel_path}")
+
+    return sorted(problems)
+
+
+def mark_staging(root: str) -> None:
+    """Mark a tree as being staged, so that it is not applied at the next boot.
+
+    Args:
+        root: Path to the tree.
+    """
+    with open(os.path.join(root, STAGING_NAME), "w"):
+        pass
+
+
+def mark_verified(root: str) -> None:
+    """Mark a staged tree as safe to apply at the next boot.
+
+    Args:
+        root: Path to the tree.
+    """
+    with open(os.path.join(root, VERIFIED_NAME), "w"):
+        pass
+
+    try:
+        os.remove(os.path.join(root, STAGING_NAME))
+    except FileNotFoundError:
+        pass
+
+
+def clear_verified(root: str) -> None:
+    """Prevent a staged tree from being applied at the next boot.
+
+    Args:
+        root: Path to the tree.
+    """
+    try:
+        os.remove(os.path.join(root, VERIFIED_NAME))
+    except FileNotFoundError:
+        pass
+
+
+def is_legacy(root: str) -> bool:
+    """Check if a tree was staged by a version without manifests.
+
+    Args:
+        root: Path to the tree.
+
+    Returns:
+        True if the tree has neither a manifest nor a staging marker.
+    """
+    return not os.path.exists(os.path.join(root, MANIFEST_NAME)) and not os.path.exists(
+        os.path.join(root, STAGING_NAME)
+    )
+
+
+def will_be_applied(root: str) -> bool:
+    """Check if a staged tree will be applied at the next boot.
+
+    Mirrors the checks of the dracut hook: legacy trees are applied as
+    before, others only once marked verified and no longer being staged.
+
+    Args:
+        root: Path to the tree.
+
+    Returns:
+        True if the tree will be applied; otherwise False.
+    """
+    if is_legacy(root):
+        return True
+
+    return os.path.isfile(os.path.join(root, VERIFIED_NAME)) and not os.path.exists(
+        os.path.join(root, STAGING_NAME)
+    )
+
+
+def check_stage(root: str, full: bool = False) -> list:
+    """Check if a staged tree is complete and matches its manifest.
+
+    Args:
+        root: Path to the tree.
+        full: Whether to hash every file.
+
+    Returns:
+        A list of strings describing each problem found.
+    """
+    problems = verify_manifest(root, full=full)
+
+    # Never set here: only completed staging may mark the tree
+    if not will_be_applied(root):
+        problems.insert(0, "the update was not completely staged")
+
+    return problems
@@ -1,18 +1,25 @@
 import filecmp
 import json
 import os
+import shutil
 import subprocess
 import sys
 
 from classes import exceptions
 from classes.rootfs import PackageManager, RootFS
-from utils import output, users
+from utils import dedupe, manifest, output, users
 
 from . import helpers
 
 
 def update_cleanup() -> None:
     """Clean-up from previous rebase/update."""
+    # /boot already holds a discarded update's files; keep the running ones
+    for stage in ["/.update_rootfs", "/.failed.update_rootfs"]:
+        if os.path.isdir(f"{stage}/.previous-boot"):
+            subprocess.run(["rm", "-rf", "/.previous-boot"])
+            subprocess.run(["mv", f"{stage}/.previous-boot", "/.previous-boot"])
+
     subprocess.run(
         [
             "rm",
@@ -21,6 +28,8 @@ def update_cleanup() -> None:
             "/var/lib/commonarch/system-image",
             "/.update",
             "/.update_rootfs",
+            "/.failed.update_rootfs",
+            "/.failed.usr.erofs",
             "/.new.etc",
             "/.new.var.lib",
         ]
@@ -73,27 +82,155 @@ def merge_var_lib(new_rootfs) -> None:
 
 
 def replace_boot_files() -> None:
-    """Replace files in /boot with those from new rootfs."""
-    new_boot_files = []
+    """Replace files in /boot with those from new rootfs.
+
+    The replaced files are kept in /.update_rootfs/.previous-boot/ for
+    system rollback.
+    """
+    new_boot_files = [
+        f
+        for f in os.listdir("/.update_rootfs/boot")
+        if not os.path.isdir(f"/.update_rootfs/boot/{f}")
+    ]
+
+    # Lets restore_boot_files() undo an interrupted or refused replacement
+    with open("/.update_rootfs/.new-boot-files", "w") as new_boot_files_file:
+        new_boot_files_file.write("".join(f"{f}\n" for f in new_boot_files))
 
-    for f in os.listdir("/.update_rootfs/boot"):
-        if not os.path.isdir(f"/.update_rootfs/boot/{f}"):
-            subprocess.run(["mv", f"/.update_rootfs/boot/{f}", "/boot"])
-            new_boot_files.append(f)
+    if os.path.isdir("/.previous-boot"):
+        subprocess.run(["mv", "/.previous-boot", "/.update_rootfs/.previous-boot"])
 
-    for f in os.listdir("/boot"):
-        if not os.path.isdir(f"/boot/{f}"):
-            if f not in new_boot_files:
+        for f in os.listdir("/boot"):
+            if not os.path.isdir(f"/boot/{f}"):
                 subprocess.run(["rm", "-f", f"/boot/{f}"])
+    else:
+        subprocess.run(["mkdir", "-p", "/.update_rootfs/.previous-boot"])
+
+        for f in os.listdir("/boot"):
+            if not os.path.isdir(f"/boot/{f}"):
+                subprocess.run(["mv", f"/boot/{f}", "/.update_rootfs/.previous-boot"])
+
+    for f in new_boot_files:
+        subprocess.run(["mv", f"/.update_rootfs/boot/{f}", "/boot"])
 
     subprocess.run(["grub-mkconfig", "-o", "/boot/grub/grub.cfg"])
 
 
-def rebase(image_name) -> None:
+def restore_boot_files(stage: str = "/.update_rootfs") -> None:
+    """Put back the files in /boot replaced by an update that was not applied.
+
+    Args:
+        stage: Path to the update, either pending or refused at boot.
+    """
+    if not os.path.isdir(f"{stage}/.previous-boot"):
+        return
+
+    try:
+        with open(f"{stage}/.new-boot-files") as new_boot_files_file:
+            new_boot_files = new_boot_files_file.read().split()
+    except FileNotFoundError:
+        new_boot_files = []
+
+    for f in new_boot_files:
+        subprocess.run(["rm", "-f", f"/boot/{f}"])
+
+    for f in os.listdir(f"{stage}/.previous-boot"):
+        subprocess.run(["mv", f"{stage}/.previous-boot/{f}", "/boot"])
+
+    subprocess.run(["rm", "-rf", f"{stage}/.previous-boot", f"{stage}/.new-boot-files"])
+    subprocess.run(["grub-mkconfig", "-o", "/boot/grub/grub.cfg"])
+
+
+def stage_rootfs_erofs(new_rootfs, kernels: list) -> bool:
+    """Copy new rootfs to /.update_rootfs, packing /usr into an EROFS image.
+
+    Args:
+        new_rootfs: Path to rootfs.
+        kernels: A list of Kernel instances from kernel_inventory().
+
+    Returns:
+        True if staged; False if the erofs userspace tools are missing or
+        a new kernel may not be able to mount the image.
+    """
+    if not (shutil.which("mkfs.erofs") and shutil.which("fsck.erofs")):
+        output.warn("erofs-utils not installed; staging /usr as a directory")
+        return False
+
+    # Otherwise the next boot would be left without /usr
+    if (
+        not shutil.which("modinfo")
+        or len(kernels) == 0
+        or not all(new_rootfs.kernel_supports_erofs(kernel) for kernel in kernels)
+    ):
+        output.warn("new kernels cannot mount EROFS; staging /usr as a directory")
+        return False
+
+    for entry in os.listdir(str(new_rootfs)):
+        if entry != "usr":
+            subprocess.run(
+                ["cp", "-ax", os.path.join(str(new_rootfs), entry), "/.update_rootfs"]
+            )
+
+    output.info("packing /usr into EROFS image")
+    if (
+        subprocess.run(
+            [
+                "mkfs.erofs",
+                "-zlz4hc",
+                "/.update_rootfs/usr.erofs",
+                f"{new_rootfs}/usr",
+            ],
+            stdout=subprocess.DEVNULL,
+        ).returncode
+        != 0
+        or subprocess.run(["fsck.erofs", "/.update_rootfs/usr.erofs"]).returncode != 0
+    ):
+        output.error("failed to create EROFS image of new /usr")
+        output.error("refusing to proceed with applying update")
+        exit(1)
+
+    return True
+
+
+def stage_rootfs(new_rootfs) -> None:
+    """Copy new rootfs to /.update_rootfs, sharing files unchanged from /usr.
+
+    Args:
+        new_rootfs: Path to rootfs.
+    """
+    with dedupe.live_root() as live_root:
+        if live_root is None:
+            output.warn("cannot access live /usr; skipping deduplication")
+            duplicates = []
+        else:
+            duplicates = dedupe.find_duplicates(str(new_rootfs), live_root)
+
+        # Identical files are not copied at all, but linked back in afterwards
+        for new_path, _, _ in duplicates:
+            os.remove(os.path.join(str(new_rootfs), new_path))
+
+        subprocess.run(["cp", "-ax", f"{new_rootfs}/.", "/.update_rootfs"])
+
+        try:
+            dedupe.link_duplicates(live_root, "/.update_rootfs", duplicates)
+        except OSError as e:
+            output.error(str(e))
+            output.error("refusing to proceed with applying update")
+            exit(1)
+
+    output.info(
+        f"deduplicated {len(duplicates)} files "
+        f"({helpers.format_size(sum(size for _, _, size in duplicates))}) "
+        "against the running system"
+    )
+
+
+def rebase(image_name, system_lock) -> None:
     """Rebase system to an OS image.
 
     Args:
         image_name: Name of image to rebase to.
+        system_lock: The held SystemLock, updated with progress.
     """
 
     update_cleanup()
@@ -116,17 +253,30 @@ def rebase(image_name) -> None:
         sys.exit(1)
 
     output.info("pulling image")
-    helpers.pull_image(image_name)
+    system_lock.update(phase="pulling image")
+    helpers.pull_image(
+        image_name,
+        rate_limit=helpers.get_rate_limit(system_config),
+        progress=lambda fraction: system_lock.update(progress=fraction),
+    )
 
     output.info("generating new rootfs")
+    system_lock.update(phase="generating new rootfs")
 
     # Load image config from pulled bundle
     with open("/var/lib/commonarch/bundle/config.json") as f:
         image_config = json.load(f)
 
     new_rootfs = RootFS(f"/var/lib/commonarch/bundle/{image_config['root']['path']}")
-    new_rootfs.copy_kernels_to_boot()
-    new_rootfs.generate_initramfs()
+    kernels = new_rootfs.kernel_inventory()
+
+    try:
+        new_rootfs.copy_kernels_to_boot(kernels)
+    except OSError as e:
+        output.error(str(e))
+        sys.exit(1)
+
+    new_rootfs.generate_initramfs(kernels)
 
     subprocess.run(["cp", "/etc/locale.gen", f"{new_rootfs}/etc/locale.gen"])
     new_rootfs.exec("locale-gen")
@@ -178,23 +328,41 @@ def rebase(image_name) -> None:
         except Exception:
             pass
 
-    if (
-        len(
-            [
-                kernel
-                for kernel in os.listdir(f"{new_rootfs}/boot")
-                if kernel.startswith("vmlinuz")
-            ]
-        )
-        == 0
+    # Kept for system rollback
+    if (current_revision := helpers.get_revision()) is not None:
+        with open(
+            "/.new.var.lib/commonarch/previous-revision", "w"
+        ) as previous_revision_file:
+            previous_revision_file.write(current_revision)
+
+    # Kernels without a modules directory are only found by name
+    if len(kernels) == 0 and not any(
+        f.startswith("vmlinuz") for f in os.listdir(f"{new_rootfs}/boot")
     ):
         output.error("new rootfs contains no kernel")
         output.error("refusing to proceed with applying update")
         exit(1)
 
     new_rootfs.exec("cp", "-ax", "/etc", "/usr/etc")
-    subprocess.run(["cp", "-ax", str(new_rootfs), "/.update_rootfs"])
+    system_lock.update(phase="staging new rootfs")
 
+    # Refused at boot until marked verified, should staging be interrupted
+    subprocess.run(["mkdir", "-p", "/.update_rootfs"])
+    manifest.mark_staging("/.update_rootfs")
+
+    if system_config.get("staging-format") != "erofs" or not stage_rootfs_erofs(
+        new_rootfs, kernels
+    ):
+        stage_rootfs(new_rootfs)
+
+    output.info("generating manifest of new rootfs")
+    system_lock.update(phase="generating manifest of new rootfs")
+    manifest.generate_manifest("/.update_rootfs")
+
+    system_lock.update(phase="replacing boot files")
     replace_boot_files()
 
+    # Only a completely staged update may be applied at the next boot
+    manifest.mark_verified("/.update_rootfs")
+
     print()
@@ -0,0 +1,111 @@
+import os
+import subprocess
+
+from utils import manifest, output
+from utils.rebase import replace_boot_files, update_cleanup
+
+from . import helpers
+
+
+def rollback() -> None:
+    """Stage the system retained by the last update as the pending update.
+
+    Files are only hardlinked; nothing is downloaded or copied.
+    """
+
+    if os.path.isfile("/.old.usr.erofs"):
+        old_usr, new_usr = "/.old.usr.erofs", "/.update_rootfs/usr.erofs"
+    else:
+        old_usr, new_usr = "/.old.usr", "/.update_rootfs/usr"
+
+    for path in [
+        old_usr,
+        "/.old.etc",
+        "/.old.var.lib",
+        "/.old.update_rootfs/.previous-boot",
+    ]:
+        if not os.path.exists(path):
+            output.error(f"{path} is missing")
+            output.error("no previous system has been retained to roll back to")
+            exit(1)
+
+    update_cleanup()
+
+    # Refused at boot until marked verified, should the rollback be interrupted
+    subprocess.run(["mkdir", "-p", "/.update_rootfs"])
+    manifest.mark_staging("/.update_rootfs")
+
+    # Hardlinked rather than moved, so that the retained trees stay intact
+    # until the next boot and an interrupted rollback can be run again
+    links = [
+        (f"/.old.update_rootfs/{entry}", f"/.update_rootfs/{entry}")
+        for entry in os.listdir("/.old.update_rootfs")
+        if entry
+        not in [
+            ".previous-boot",
+            ".new-boot-files",
+            manifest.MANIFEST_NAME,
+            manifest.VERIFIED_NAME,
+            manifest.STAGING_NAME,
+            # Left over from the update being rolled back
+            "usr",
+            "usr.erofs",
+            "etc",
+        ]
+    ]
+    links += [
+        (old_usr, new_usr),
+        ("/.old.etc", "/.new.etc"),
+        ("/.old.var.lib", "/.new.var.lib"),
+    ]
+    links += [
+        (f"/.old.update_rootfs/.previous-boot/{f}", f"/.update_rootfs/boot/{f}")
+        for f in os.listdir("/.old.update_rootfs/.previous-boot")
+    ]
+
+    for source, target in links:
+        subprocess.run(["mkdir", "-p", os.path.dirname(target)])
+        if subprocess.run(["cp", "-al", source, target]).returncode != 0:
+            output.error(f"failed to link {source} to {target}")
+            exit(1)
+
+    subprocess.run(["rm", "-rf", "/.update_rootfs/var/cache/pacman"])
+    if os.path.isdir("/.old.var.cache.pacman"):
+        if (
+            subprocess.run(
+                [
+                    "cp",
+                    "-al",
+                    "/.old.var.cache.pacman",
+                    "/.update_rootfs/var/cache/pacman",
+                ]
+            ).returncode
+            != 0
+        ):
+            output.error("failed to link /.old.var.cache.pacman")
+            exit(1)
+
+    # Recorded the other way round so that rolling back again returns here
+    target_revision = helpers.get_revision("/.new.var.lib")
+    if (current_revision := helpers.get_revision()) is not None:
+        subprocess.run(["mkdir", "-p", "/.new.var.lib/commonarch"])
+        # Replaced rather than written to, as it is linked to the retained tree
+        subprocess.run(["rm", "-f", "/.new.var.lib/commonarch/previous-revision"])
+        with open(
+            "/.new.var.lib/commonarch/previous-revision", "w"
+        ) as previous_revision_file:
+            previous_revision_file.write(current_revision)
+
+    # The retained trees were in use until the last update, so stat data
+    # is enough; hashing all of /usr would defeat the point of a rollback.
+    manifest.generate_manifest("/.update_rootfs", checksums=False)
+
+    replace_boot_files()
+
+    # Only a completely staged rollback may be applied at the next boot
+    manifest.mark_verified("/.update_rootfs")
+
+    print()
+
+    if target_revision is not None:
+        output.info(f"rolling back to revision {target_revision}")